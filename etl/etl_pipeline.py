@@ -4,28 +4,49 @@ from etl.load import DatabaseLoader
 
 from config.config import Config
 
+import itertools
 import logging
+import queue
+import threading
+
+# rows handed to executemany per transaction
+BATCH_SIZE = 10000
+# section batches handed from the transformer to the loader thread, and how many may wait
+QUEUE_BATCH_SIZE = 5000
+QUEUE_MAXSIZE = 8
+
+def batched(rows, size=BATCH_SIZE):
+    """
+    Yields lists of at most `size` rows from any iterable
+    """
+    iterator = iter(rows)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 class ETLPipeline:
-    def __init__(self, user_params):
+    def __init__(self, user_params, session=None):
         self.admin_config = Config('admin')
         self.versioner_config = Config('versioner', user_params)
         
-        self.admin_extractor = DataExtractor(self.admin_config.params)
+        # both extractors share one keep-alive session (the module default if none is given)
+        self.admin_extractor = DataExtractor(self.admin_config.params, session=session)
+        self.session = self.admin_extractor.session
         self.admin_transformer = DataTransformer(self.admin_config.params)
 
-        self.versioner_extractor = DataExtractor(self.versioner_config.params)
+        self.versioner_extractor = DataExtractor(self.versioner_config.params, session=self.session)
         self.versioner_transformer = DataTransformer(self.versioner_config.params)
 
         self.db_loader = DatabaseLoader(db_path='data/cfr.db')
 
-    def run_pipeline(self):
-        logging.info("Running admin pipeline...")
-        admin_raw_data = self.admin_extractor.extract_data()
-        admin_transformed = self.admin_transformer.transform_proxy(admin_raw_data)
-
-        logging.info("Loading admin data into database...")
-        self.load_admin_data(admin_transformed)
+    def run_pipeline(self, finalize=True):
+        """
+        Loads the agencies and this pipeline's title. Callers loading many titles
+        pass finalize=False and build the indexes once after the last one
+        """
+        self.run_admin_pipeline()
 
         logging.info("Running versioner pipeline...")
         versioner_raw_data = self.versioner_extractor.extract_data()
@@ -34,17 +55,68 @@ class ETLPipeline:
         logging.info("Loading versioner data into database...")
         self.load_versioner_data(versioner_transformed)
 
+        if finalize:
+            logging.info("Building database indexes...")
+            self.db_loader.finalize()
+
+    def run_admin_pipeline(self):
+        logging.info("Running admin pipeline...")
+        admin_raw_data = self.admin_extractor.extract_data()
+        admin_transformed = self.admin_transformer.transform_proxy(admin_raw_data)
+
+        logging.info("Loading admin data into database...")
+        self.load_admin_data(admin_transformed)
 
     def load_admin_data(self, transformed_admin_data):
-        for agency in transformed_admin_data:
-            self.db_loader.insert_agency(agency)
+        agency_rows, reference_rows = transformed_admin_data
 
-            agency_id = agency['agency_id']
-            cfr_refs = agency.get('cfr_references', [])
+        for batch in batched(agency_rows):
+            self.db_loader.insert_agencies_bulk(batch)
 
-            for ref in cfr_refs:
-                self.db_loader.insert_cfr_reference(agency_id, ref)
+        for batch in batched(reference_rows):
+            self.db_loader.insert_cfr_references_bulk(batch)
 
     def load_versioner_data(self, transformed_versioner_data):
-        for section in transformed_versioner_data:
-            self.db_loader.insert_cfr_section(section)
+        """
+        Inserts sections on a loader thread while the calling thread keeps
+        parsing, with at most QUEUE_MAXSIZE batches buffered in between.
+        Batches are committed as they arrive; if parsing or loading fails
+        partway, the batches already committed are deleted again, so a title
+        is either loaded whole or not at all
+        """
+        batches = queue.Queue(maxsize=QUEUE_MAXSIZE)
+        errors = []
+        # (first, last) section_id of every committed batch
+        loaded_ranges = []
+
+        def loader_worker():
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    return
+                if errors:
+                    # keep draining so the producer never blocks on a full queue
+                    continue
+                try:
+                    loaded_ranges.append(self.db_loader.insert_cfr_sections_bulk(batch))
+                except Exception as e:
+                    errors.append(e)
+
+        worker = threading.Thread(target=loader_worker, daemon=True)
+        worker.start()
+        completed = False
+        try:
+            for batch in batched(transformed_versioner_data, QUEUE_BATCH_SIZE):
+                if errors:
+                    break
+                batches.put(batch)
+            completed = True
+        finally:
+            batches.put(None)
+            worker.join()
+            if (errors or not completed) and loaded_ranges:
+                logging.warning(f"Removing {len(loaded_ranges)} partially loaded section batches")
+                self.db_loader.delete_cfr_sections(loaded_ranges)
+
+        if errors:
+            raise errors[0]
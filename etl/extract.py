@@ -1,7 +1,36 @@
 import requests
 import json
+import orjson
 from typing import Dict, Any
+from requests.adapters import HTTPAdapter
 import logging
+import mmap
+import os
+import tempfile
+import time
+
+USER_AGENT = 'ecfr-dashboard'
+VERSIONER_ENDPOINT = 'api/versioner/v1/full/{date}/title-{title}.xml'
+# (connect, read) timeouts in seconds; streamed XML gets a longer read window
+REQUEST_TIMEOUT = (5, 60)
+STREAM_TIMEOUT = (5, 120)
+# statuses worth retrying: throttling and transient server errors
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+MAX_ATTEMPTS = 5
+BACKOFF_FACTOR = 0.5
+# downloaded payloads are kept here; versioner XML never changes for a given (date, title),
+# while the agencies list does, so it is only reused for ADMIN_CACHE_TTL seconds
+CACHE_DIR = 'data/cache'
+ADMIN_CACHE_TTL = 3600
+
+def build_session():
+    """
+    Creates a requests session that keeps HTTPS connections to ecfr.gov alive
+    """
+    session = requests.Session()
+    session.headers['User-Agent'] = USER_AGENT
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=16))
+    return session
 
 class ServiceNotImplementedError(Exception):
     """
@@ -12,11 +41,83 @@ class ServiceNotImplementedError(Exception):
         # Call the base Exception class's constructor with the message
         super().__init__(f"{message}: '{service_type}'")
 
+class CachingReader:
+    """
+    File-like wrapper that copies everything read from a stream into a cache file.
+    The copy is only published by publish(), once the consumer has read the stream
+    to the end and accepted its contents; otherwise close() discards it
+    """
+    def __init__(self, stream, path):
+        self.stream = stream
+        self.path = path
+        fd, self.partial_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+        self.complete = False
+        self.published = False
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        if data:
+            self.file.write(data)
+        else:
+            self.complete = True
+        return data
+
+    def publish(self):
+        """
+        Moves the copy into the cache; called once the payload parsed cleanly
+        """
+        if not self.complete:
+            raise ValueError(f'Cannot cache {self.path}: the stream was not read to the end')
+        self.file.close()
+        os.replace(self.partial_path, self.path)
+        self.published = True
+
+    def close(self):
+        self.stream.close()
+        if not self.published:
+            # the stream was abandoned or failed to parse, so the copy is not trusted
+            self.file.close()
+            os.remove(self.partial_path)
+
 class DataExtractor:
-    def __init__(self, params = Dict):
+    # shared by every extractor that is not given its own session
+    _SESSION = build_session()
+
+    def __init__(self, params = Dict, session: requests.Session = None, cache_dir: str = CACHE_DIR):
         self.base_url = params.get('base_url', None)
         self.endpoint = params.get('endpoint', None)
         self.params = params
+        self.session = session or self._SESSION
+        # None disables the on-disk cache
+        self.cache_dir = cache_dir
+
+    def cache_path(self, name):
+        """
+        Returns where a payload is cached, or None when caching is disabled
+        """
+        if not self.cache_dir:
+            return None
+        os.makedirs(self.cache_dir, exist_ok=True)
+        return os.path.join(self.cache_dir, name)
+
+    def get(self, url, **kwargs):
+        """
+        GETs a URL through the session, retrying connection errors and
+        RETRY_STATUSES with exponential backoff before giving up
+        """
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                response = self.session.get(url, **kwargs)
+                response.raise_for_status()
+                return response
+            except requests.exceptions.RequestException as e:
+                status = e.response.status_code if e.response is not None else None
+                if attempt == MAX_ATTEMPTS - 1 or (status is not None and status not in RETRY_STATUSES):
+                    logging.exception(f'Error fetching {url}')
+                    raise
+                logging.warning(f'Error fetching {url}: {e}, retrying...')
+                time.sleep(BACKOFF_FACTOR * 2 ** attempt)
 
     def extract_data(self):
         """
@@ -29,26 +130,37 @@ class DataExtractor:
             raise ValueError("Missing 'service' key in parameters.")
 
         if self.params['service'] == 'admin':
-            try: 
-                response = requests.get(f'{self.base_url}/{self.endpoint}')
-                response.raise_for_status()
-                retrieved_data = response.json()
-            except requests.exceptions.RequestException as e:
-                print(f'Error fetching Admin data: {e}')
+            path = self.cache_path('agencies.json')
+            if path and os.path.exists(path) and time.time() - os.path.getmtime(path) < ADMIN_CACHE_TTL:
+                with open(path, 'rb') as f:
+                    return orjson.loads(f.read())
 
-            return retrieved_data
+            response = self.get(f'{self.base_url}/{self.endpoint}', timeout=REQUEST_TIMEOUT)
+            if path:
+                fd, partial_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.part')
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(response.content)
+                os.replace(partial_path, path)
+            # orjson parses the raw bytes directly, skipping the text decode done by response.json()
+            return orjson.loads(response.content)
 
         elif self.params['service'] == 'versioner':
-            try:
-                date = self.params['date']
-                title = self.params['title']
-                xml_endpoint = f'api/versioner/v1/full/{date}/title-{title}.xml'
-                response = requests.get(f'{self.base_url}/{xml_endpoint}')
-                response.raise_for_status()
-                xml_content = response.text
-            except requests.exceptions.RequestException as e:
-                print(f'Error fetching XML data: {e}')
-            
-            return xml_content
+            date = self.params['date']
+            title = self.params['title']
+            path = self.cache_path(f'title-{title}-{date}.xml')
+            if path and os.path.exists(path) and os.path.getsize(path) > 0:
+                # iterparse reads straight from the mapping, so the page cache holds the
+                # bytes and no payload-sized buffer is allocated in Python
+                with open(path, 'rb') as f:
+                    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+            xml_endpoint = VERSIONER_ENDPOINT.format(date=date, title=title)
+            response = self.get(f'{self.base_url}/{xml_endpoint}', stream=True, timeout=STREAM_TIMEOUT)
+            # the raw socket goes straight to iterparse, which parses while bytes arrive
+            response.raw.decode_content = True
+            if path:
+                # the cache file is written as the parser consumes the stream
+                return CachingReader(response.raw, path)
+            return response.raw
         else:
-            raise ServiceNotImplementedError(self.params['service'])
\ No newline at end of file
+            raise ServiceNotImplementedError(self.params['service'])
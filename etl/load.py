@@ -1,13 +1,54 @@
 import sqlite3
 import logging
+from contextlib import contextmanager
+
+# statements are kept as constants so sqlite3's statement cache reuses one prepared plan each
+INSERT_AGENCY_SQL = '''
+    INSERT OR REPLACE INTO agencies
+    (agency_id, name, short_name, display_name, sortable_name, slug, parent_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+INSERT_SECTION_SQL = '''
+    INSERT INTO cfr_sections
+    (title_number, title_head, chapter_number, chapter_head,
+    subchapter_number, subchapter_head, part_number, part_head,
+    section_number, section_title, body)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+INSERT_REFERENCE_SQL = '''
+    INSERT INTO cfr_references (agency_id, title, chapter, part)
+    VALUES (?, ?, ?, ?)
+'''
+# seconds a writer waits for the database lock; several pipelines may load titles at once
+BUSY_TIMEOUT = 60
 
 class DatabaseLoader:
     def __init__(self, db_path='data/cfr.db'):
-        self.conn = sqlite3.connect(db_path)
+        # autocommit mode: transactions are opened explicitly by the bulk inserts,
+        # and sections are written from ETLPipeline's loader thread
+        self.conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
         self.create_tables()
 
+    @contextmanager
+    def transaction(self):
+        """
+        Wraps a block in BEGIN IMMEDIATE / COMMIT, rolling back on error
+        """
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        self.conn.execute('COMMIT')
+
     def create_tables(self):
-        with self.conn:
+        # WAL + NORMAL sync avoids an fsync per commit during bulk loads
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA temp_store=MEMORY')
+
+        with self.transaction():
             self.conn.execute('''
                 CREATE TABLE IF NOT EXISTS agencies (
                     agency_id INTEGER PRIMARY KEY,
@@ -46,12 +87,28 @@ class DatabaseLoader:
                 )
             ''')
 
-    def insert_agency(self, agency):
-        self.conn.execute('''
-                INSERT OR REPLACE INTO agencies 
-                (agency_id, name, short_name, display_name, sortable_name, slug, parent_id)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
+    def finalize(self):
+        """
+        Builds the lookup indexes once the bulk load is done, rather than
+        maintaining them row by row during the inserts
+        """
+        with self.transaction():
+            self.conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_sections_title_part
+                ON cfr_sections (title_number, part_number)
+            ''')
+            self.conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_sections_title_chapter_part
+                ON cfr_sections (title_number, chapter_number, part_number)
+            ''')
+            self.conn.execute('''
+                CREATE INDEX IF NOT EXISTS idx_refs_agency
+                ON cfr_references (agency_id)
+            ''')
+
+    def insert_agencies_bulk(self, agencies):
+        with self.transaction():
+            self.conn.executemany(INSERT_AGENCY_SQL, [(
                 agency['agency_id'],
                 agency['name'],
                 agency['short_name'],
@@ -59,38 +116,29 @@ class DatabaseLoader:
                 agency['sortable_name'],
                 agency['slug'],
                 agency['parent_id']
-            ))
-        
-    def insert_cfr_section(self, section):
-        with self.conn:
-            self.conn.execute('''
-                INSERT INTO cfr_sections 
-                (title_number, title_head, chapter_number, chapter_head, 
-                subchapter_number, subchapter_head, part_number, part_head, 
-                section_number, section_title, body)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                section['title_number'],
-                section['title_head'],
-                section['chapter_number'],
-                section['chapter_head'],
-                section['subchapter_number'],
-                section['subchapter_head'],
-                section['part_number'],
-                section['part_head'],
-                section['section_number'],
-                section['section_title'],
-                section['body']
-            ))
-    
-    def insert_cfr_reference(self, agency_id, reference):
-        with self.conn:
-            self.conn.execute('''
-                INSERT INTO cfr_references (agency_id, title, chapter, part)
-                VALUES (?, ?, ?, ?)
-            ''', (
-                agency_id,
-                reference.get('title'),
-                reference.get('chapter'),
-                reference.get('part')
-            ))
\ No newline at end of file
+            ) for agency in agencies])
+
+    def insert_cfr_sections_bulk(self, sections):
+        """
+        Inserts etl.transform.Section rows (or plain tuples in the same order) and returns
+        the batch's (first, last) section_id. The batch holds the write lock while it
+        inserts, so its ids are contiguous even with other loaders on the database
+        """
+        with self.transaction():
+            cursor = self.conn.executemany(INSERT_SECTION_SQL, sections)
+            last_id = self.conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+        return last_id - cursor.rowcount + 1, last_id
+
+    def delete_cfr_sections(self, id_ranges):
+        """
+        Deletes the sections in (first, last) section_id ranges from insert_cfr_sections_bulk
+        """
+        with self.transaction():
+            self.conn.executemany('DELETE FROM cfr_sections WHERE section_id BETWEEN ? AND ?', id_ranges)
+
+    def insert_cfr_references_bulk(self, references):
+        """
+        Inserts (agency_id, title, chapter, part) reference tuples
+        """
+        with self.transaction():
+            self.conn.executemany(INSERT_REFERENCE_SQL, references)
@@ -1,7 +1,8 @@
-from typing import Dict, Any
+from typing import Dict, Any, NamedTuple
+from io import BytesIO
 from lxml import etree
-import re
 import logging
+import sys
 
 class ServiceNotImplementedError(Exception):
     """
@@ -12,15 +13,35 @@ class ServiceNotImplementedError(Exception):
         # Call the base Exception class's constructor with the message
         super().__init__(f"{message}: '{service_type}'")
 
+# CFR hierarchy levels a section must sit under: TITLE > CHAPTER > SUBCHAPTER > PART
+HIERARCHY_TAGS = ('DIV1', 'DIV3', 'DIV4', 'DIV5')
+# every DIV whose N attribute and HEAD are tracked while streaming, sections included
+CONTEXT_TAGS = HIERARCHY_TAGS + ('DIV8',)
+
+class Section(NamedTuple):
+    """
+    A cfr_sections row; field order matches the table's insert columns,
+    so instances go straight into executemany
+    """
+    title_number: str
+    title_head: str
+    chapter_number: str
+    chapter_head: str
+    subchapter_number: str
+    subchapter_head: str
+    part_number: str
+    part_head: str
+    section_number: str
+    section_title: str
+    body: str
+
 class DataTransformer:
     def __init__(self, params = Dict):
         self.params = params
 
     def clean_text(self, text):
-        if text:
-            # check whitespaces and strip
-            return re.sub(r'\s+', ' ', text).strip()
-        return ''
+        # str.split() collapses any run of whitespace and drops leading/trailing ones
+        return ' '.join(text.split()) if text else ''
     
     def transform_proxy(self, api_response):
 
@@ -32,117 +53,160 @@ class DataTransformer:
             raise ServiceNotImplementedError(self.params['service'])
         
     def transform_admin_api(self, api_response):
+        """
+        Returns (agency_rows, reference_rows): agency dicts, plus
+        (agency_id, title, chapter, part) tuples ready for executemany
+        """
 
         if self.params['service'] != 'admin':
             raise Exception('Wrong Service Called')
         
         agencies = api_response.get('agencies', [])
         rows = []
-        # track parent-child mapping
-        slug_to_id = {} 
+        reference_rows = []
         # handling auto increment of the PK
         next_id = 1
 
         for agency in agencies:
-            parent_id = None
-            agency_slug = self.clean_text(agency['slug'])
-
-            agency_cfr_refs = [
-                {
-                    'title': ref.get('title'),
-                    'chapter': ref.get('chapter'),
-                    'part': ref.get('part')
-                }
-                for ref in agency.get('cfr_references', [])
-            ]
-
-            row = {
-                'agency_id': next_id,
-                'name': self.clean_text(agency['name']),
-                'short_name': self.clean_text(agency.get('short_name')),
-                'display_name': self.clean_text(agency.get('display_name')),
-                'sortable_name': self.clean_text(agency.get('sortable_name')),
-                'slug': agency_slug,
-                'parent_id': parent_id,
-                'cfr_references': agency_cfr_refs
-            }
-            rows.append(row)
-            slug_to_id[agency_slug] = next_id
+            agency_id = next_id
+            rows.append(self.admin_row(agency, None, agency_id))
+            reference_rows.extend(self.admin_reference_rows(agency, agency_id))
             next_id += 1
-            
-            # children process
-            for child in agency.get('children', []):
-                child_slug = self.clean_text(child['slug'])
-
-                child_cfr_refs = [
-                    {
-                        'title': ref.get('title'),
-                        'chapter': ref.get('chapter'),
-                        'part': ref.get('part')
-                    }
-                    for ref in child.get('cfr_references', [])
-                ]
-
-                child_row = {
-                    'agency_id': next_id,
-                    'name': self.clean_text(child['name']),
-                    'short_name': self.clean_text(child.get('short_name')),
-                    'display_name': self.clean_text(child.get('display_name')),
-                    'sortable_name': self.clean_text(child.get('sortable_name')),
-                    'slug': child_slug,
-                    'parent_id': slug_to_id[agency_slug],  # parent points to main agency
-                    'cfr_references': child_cfr_refs
-                }
-                rows.append(child_row)
-                slug_to_id[child_slug] = next_id
+
+            # children point to the main agency as their parent
+            for child in agency.get('children', ()):
+                rows.append(self.admin_row(child, agency_id, next_id))
+                reference_rows.extend(self.admin_reference_rows(child, next_id))
                 next_id += 1
         
-        return rows
+        return rows, reference_rows
+
+    def admin_row(self, entity, parent_id, agency_id):
+        """
+        Builds the agencies row for a top-level agency or one of its children
+        """
+        return {
+            'agency_id': agency_id,
+            'name': self.clean_text(entity['name']),
+            'short_name': self.clean_text(entity.get('short_name')),
+            'display_name': self.clean_text(entity.get('display_name')),
+            'sortable_name': self.clean_text(entity.get('sortable_name')),
+            'slug': self.clean_text(entity['slug']),
+            'parent_id': parent_id
+        }
+
+    def admin_reference_rows(self, entity, agency_id):
+        """
+        Yields the cfr_references rows of an agency or child agency
+        """
+        for ref in entity.get('cfr_references', ()):
+            yield (agency_id, ref.get('title'), ref.get('chapter'), ref.get('part'))
 
     def transform_versioner_api(self, api_response):
         if self.params['service'] != 'versioner':
             raise Exception('Wrong Service Called')
-        
-        
-        root = etree.fromstring(api_response.encode('utf-8'))
-        cfr_data = []
-
-        for div1 in root.findall('.//DIV1'):  # TITLE
-            title_number = div1.get('N')
-            title_head = (div1.findtext('HEAD') or '').strip()
-
-            for div3 in div1.findall('.//DIV3'):  # CHAPTER
-                chapter_number = div3.get('N')
-                chapter_head = (div3.findtext('HEAD') or '').strip()
-
-                for div4 in div3.findall('.//DIV4'):  # SUBCHAPTER
-                    subchapter_number = div4.get('N')
-                    subchapter_head = (div4.findtext('HEAD') or '').strip()
-
-                    for div5 in div4.findall('.//DIV5'):  # PART
-                        part_number = div5.get('N')
-                        part_head = (div5.findtext('HEAD') or '').strip()
-
-                        for div8 in div5.findall('.//DIV8'):
-                            section_number = div8.get('N')
-                            section_title = (div8.findtext('HEAD') or '').strip()
-                            body = ' '.join(' '.join(p.itertext()).strip() for p in div8.findall('.//P'))
-
-                            cfr_data.append({
-                                'title_number': title_number,
-                                'title_head': title_head,
-                                'chapter_number': chapter_number,
-                                'chapter_head': chapter_head,
-                                'subchapter_number': subchapter_number,
-                                'subchapter_head': subchapter_head,
-                                'part_number': part_number,
-                                'part_head': part_head,
-                                'section_number': section_number,
-                                'section_title': section_title,
-                                'body': body
-                            })
-
-        return cfr_data
-
-
-    
\ No newline at end of file
+
+        if isinstance(api_response, str):
+            api_response = api_response.encode('utf-8')
+        if isinstance(api_response, bytes):
+            api_response = BytesIO(api_response)
+
+        return self.iter_versioner_sections(api_response)
+
+    def intern_level(self, tag, value):
+        """
+        Interns title/chapter/subchapter/part numbers and heads, which repeat on
+        every section row below them; section-level values are left alone
+        """
+        if value and tag in HIERARCHY_TAGS:
+            return sys.intern(value)
+        return value
+
+    def iter_versioner_sections(self, xml_stream):
+        """
+        Streams section rows out of the versioner XML as each DIV8 closes,
+        so only the enclosing title/chapter/subchapter/part stay in memory.
+        Rows are Section tuples, ready for executemany
+        """
+        # open DIVs on the current path, keyed by tag: {'number': ..., 'head': ...}
+        context = {}
+
+        # lxml filters events by tag in C, so P/I/E and other inline elements never reach Python
+        # huge_tree lifts libxml2's size limits for the largest titles; malformed or truncated
+        # payloads raise XMLSyntaxError once the parser reaches the damage. Sections yielded
+        # before that point are already out, so ETLPipeline.load_versioner_data deletes the
+        # batches it committed for the title when this raises
+        events = etree.iterparse(
+            xml_stream,
+            events=('start', 'end'),
+            tag=CONTEXT_TAGS + ('HEAD',),
+            huge_tree=True
+        )
+        seen_title = False
+
+        try:
+            for event, elem in events:
+                tag = elem.tag
+
+                if event == 'start':
+                    if tag == 'DIV1':
+                        seen_title = True
+                    if tag in CONTEXT_TAGS:
+                        context[tag] = {'number': self.intern_level(tag, elem.get('N')), 'head': None}
+                    continue
+
+                if tag == 'HEAD':
+                    parent_tag = elem.getparent().tag
+                    parent = context.get(parent_tag)
+                    if parent is not None and parent['head'] is None:
+                        parent['head'] = self.intern_level(parent_tag, (elem.text or '').strip())
+                    continue
+
+                if tag not in CONTEXT_TAGS:
+                    continue
+
+                # sections are only reported under a full title > chapter > subchapter > part path
+                if tag == 'DIV8' and all(level in context for level in HIERARCHY_TAGS):
+                    title, chapter = context['DIV1'], context['DIV3']
+                    subchapter, part = context['DIV4'], context['DIV5']
+                    section = context['DIV8']
+                    # iterdescendants walks the section once without compiling a .//P path, and
+                    # tostring(method='text') concatenates each paragraph's text nodes in C
+                    paragraphs = (
+                        etree.tostring(p, method='text', encoding='unicode', with_tail=False)
+                        for p in elem.iterdescendants('P')
+                    )
+                    body = ' '.join(' '.join(paragraphs).split())
+
+                    yield Section(
+                        title['number'],
+                        title['head'] or '',
+                        chapter['number'],
+                        chapter['head'] or '',
+                        subchapter['number'],
+                        subchapter['head'] or '',
+                        part['number'],
+                        part['head'] or '',
+                        section['number'],
+                        section['head'] or '',
+                        body
+                    )
+
+                del context[tag]
+
+                # free the processed subtree and any siblings already handled
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+            # well-formed but not a title document, e.g. an HTML error page
+            if not seen_title:
+                raise ValueError('Versioner payload contains no title (DIV1) element')
+
+            # only a cleanly parsed payload is kept in the extractor's on-disk cache
+            if hasattr(xml_stream, 'publish'):
+                xml_stream.publish()
+        finally:
+            # releases the connection or file handle behind the stream
+            if hasattr(xml_stream, 'close'):
+                xml_stream.close()
@@ -1,22 +1,33 @@
 import streamlit as st
 from datetime import date, datetime, timedelta
-import requests
 import pandas as pd
 import numpy as np
 import hashlib
-import altair as alt
-import plotly.express as px
 import os
+import re
 import sqlite3
-
-from etl.etl_pipeline import ETLPipeline
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from utils.db_utils import (
     get_agencies_data,
     get_cfr_sections_data,
-    get_cfr_references_data
+    get_cfr_references_data,
+    get_joined_dashboard_data,
+    get_joined_summary,
+    get_row_count
 )
 
+# titles are fetched and loaded concurrently; the requests are I/O bound, and the shared
+# extractor session keeps up to 16 connections to ecfr.gov alive
+ETL_WORKERS = 8
+
+# rows of cfr_sections and of the joined data read for the Raw Data Debug mode
+DEBUG_ROW_LIMIT = 1000
+
+# fallback match for the section text column when neither section_text nor body exists
+TEXT_COLUMN_PATTERN = re.compile(r'text|body|content', re.IGNORECASE)
+
 # --- Database Check Functions ---
 
 def check_database_exists(db_path="data/cfr.db"):
@@ -52,210 +63,86 @@ def check_database_has_data(db_path="data/cfr.db"):
         st.error(f"Error checking database: {e}")
         return False
 
-def safe_load_data():
+def safe_load_data(dashboard_mode=None):
     """
-    Safely load data with error handling
+    Safely load data with error handling. Returns the agencies, the section and reference
+    frames (only read by the Raw Data Debug mode, which samples the sections; None in the
+    analytics modes, which work off the SQL-joined data) and the table row counts
     """
     try:
         agency_df = get_agencies_data()
-        section_df = get_cfr_sections_data()
-        reference_df = get_cfr_references_data()
+        row_counts = {table: get_row_count(table) for table in ('cfr_sections', 'cfr_references')}
         
-        if agency_df.empty or section_df.empty or reference_df.empty:
-            return None, None, None
+        if agency_df.empty or not all(row_counts.values()):
+            return None, None, None, None
         
-        return agency_df, section_df, reference_df
+        if dashboard_mode == "Raw Data Debug":
+            section_df = get_cfr_sections_data(limit=DEBUG_ROW_LIMIT)
+            reference_df = get_cfr_references_data()
+        else:
+            section_df = reference_df = None
+        
+        return agency_df, section_df, reference_df, row_counts
     
     except Exception as e:
         st.error(f"Error loading data: {e}")
-        return None, None, None
+        return None, None, None, None
 
 # --- Enhanced Dashboard Functions ---
 
-def create_comprehensive_agency_analysis(agency_df, section_df, reference_df):
-    """
-    Creates comprehensive analysis by properly joining reference_df with section_df
-    based on title, chapter, part matching logic, then joining with agency_df
-    """
-    st.info("🔄 Processing data joins with custom matching logic...")
-    
-    reference_df = reference_df.copy()
-    section_df = section_df.copy()
-    agency_df = agency_df.copy()
-    
-    # Debug: Check column names and data types
-    st.write("**Debug - Column Info:**")
-    st.write(f"Reference columns: {reference_df.columns.tolist()}")
-    st.write(f"Section columns: {section_df.columns.tolist()}")
-    st.write(f"Agency columns: {agency_df.columns.tolist()}")
-    
-    # For reference_df
-    title_col_ref = None
-    chapter_col_ref = None
-    part_col_ref = None
-    
-    for col in reference_df.columns:
-        if 'title' in col.lower():
-            title_col_ref = col
-        elif 'chapter' in col.lower():
-            chapter_col_ref = col
-        elif 'part' in col.lower():
-            part_col_ref = col
-    
-    title_col_sec = None
-    chapter_col_sec = None
-    part_col_sec = None
-    text_col_sec = None
-    
-    for col in section_df.columns:
-        if 'title' in col.lower() and 'number' in col.lower():
-            title_col_sec = col
-        elif 'chapter' in col.lower() and 'number' in col.lower():
-            chapter_col_sec = col
-        elif 'part' in col.lower() and 'number' in col.lower():
-            part_col_sec = col
-        elif any(keyword in col.lower() for keyword in ['text', 'body', 'content']):
-            text_col_sec = col
-    
-    st.write(f"**Identified columns:**")
-    st.write(f"Reference - Title: {title_col_ref}, Chapter: {chapter_col_ref}, Part: {part_col_ref}")
-    st.write(f"Section - Title: {title_col_sec}, Chapter: {chapter_col_sec}, Part: {part_col_sec}, Text: {text_col_sec}")
-    
-    if not all([title_col_ref, title_col_sec]):
-        st.error("Could not identify title columns for joining!")
-        return None
-    
-    reference_df[title_col_ref] = reference_df[title_col_ref].astype(str)
-    section_df[title_col_sec] = section_df[title_col_sec].astype(str)
-    
-    if chapter_col_ref and chapter_col_sec:
-        reference_df[chapter_col_ref] = reference_df[chapter_col_ref].astype(str)
-        section_df[chapter_col_sec] = section_df[chapter_col_sec].astype(str)
-    
-    if part_col_ref and part_col_sec:
-        reference_df[part_col_ref] = reference_df[part_col_ref].fillna('').astype(str)
-        section_df[part_col_sec] = section_df[part_col_sec].fillna('').astype(str)
-
-    agency_sections = []
-    
-    progress_bar = st.progress(0)
-    total_refs = len(reference_df)
-    matches_found = 0
-    
-    for idx, (_, ref_row) in enumerate(reference_df.iterrows()):
-        agency_id = ref_row['agency_id']
-        title = str(ref_row[title_col_ref])
-        
-        mask = (section_df[title_col_sec] == title)
-        
-        if chapter_col_ref and chapter_col_sec and pd.notna(ref_row.get(chapter_col_ref)):
-            chapter = str(ref_row[chapter_col_ref])
-            mask &= (section_df[chapter_col_sec] == chapter)
-        
-        if part_col_ref and part_col_sec and pd.notna(ref_row.get(part_col_ref)) and ref_row.get(part_col_ref) != '':
-            part = str(ref_row[part_col_ref])
-            mask &= (section_df[part_col_sec] == part)
-        
-        matching_sections = section_df[mask].copy()
-        
-        if not matching_sections.empty:
-            matching_sections['agency_id'] = agency_id
-            agency_sections.append(matching_sections)
-            matches_found += len(matching_sections)
-        
-        # Update progress every 100 iterations to avoid too frequent updates
-        if idx % 100 == 0 or idx == total_refs - 1:
-            progress_bar.progress((idx + 1) / total_refs)
-    
-    progress_bar.empty()
-    
-    st.success(f"Found {matches_found} section matches across {len(agency_sections)} reference entries")
-    
-    if agency_sections:
-        combined_sections = pd.concat(agency_sections, ignore_index=True)
-        st.write(f"Combined sections shape: {combined_sections.shape}")
-    else:
-        st.error("No matching sections found!")
-        return None
-    
-    agency_data = combined_sections.merge(agency_df, on='agency_id', how='left')
-    
-    # Check for successful joins
-    successful_joins = (~agency_data['name'].isna()).sum()
-    st.write(f"Successfully joined {successful_joins} out of {len(agency_data)} section records with agency data")
-    
-    if successful_joins == 0:
-        st.error("No successful joins with agency data! Check if agency_id columns match.")
-        st.write("Sample agency_ids in reference_df:", reference_df['agency_id'].unique()[:10])
-        st.write("Sample agency_ids in agency_df:", agency_df['agency_id'].unique()[:10])
-        return None
-    
-    return agency_data
-
 def calculate_enhanced_metrics(agency_data):
     """
     Calculate comprehensive metrics for the dashboard
     """
     
     # 1. Word count analysis
-    if 'section_text' in agency_data.columns:
-        text_col = 'section_text'
-    elif 'body' in agency_data.columns:
-        text_col = 'body'
-    else:
-        text_cols = [col for col in agency_data.columns if 'text' in col.lower() or 'body' in col.lower()]
-        text_col = text_cols[0] if text_cols else None
+    text_col = identify_text_column(tuple(agency_data.columns))
     
     if text_col is None:
         st.error("No text column found in the data")
         return None
     
-    agency_data['word_count'] = agency_data[text_col].fillna('').str.split().str.len()
-    
-    word_counts = agency_data.groupby(['agency_id', 'name']).agg({
-        'word_count': ['sum', 'count', 'mean'],
-        text_col: 'count'
-    }).reset_index()
-    
-    word_counts.columns = ['agency_id', 'agency_name', 'total_words', 'section_count', 'avg_words_per_section', 'total_sections']
-    
-    # 2. Generate checksums
-    agency_checksums = []
-    for agency_id in agency_data['agency_id'].unique():
-        agency_text = agency_data[agency_data['agency_id'] == agency_id][text_col].fillna('').str.cat(sep=' ')
-        checksum = hashlib.md5(agency_text.encode()).hexdigest()
-        agency_name = agency_data[agency_data['agency_id'] == agency_id]['name'].iloc[0]
-        agency_checksums.append({
-            'agency_id': agency_id,
-            'agency_name': agency_name,
-            'checksum': checksum,
-            'content_length': len(agency_text)
-        })
-    
-    checksums_df = pd.DataFrame(agency_checksums)
+    agency_data['word_count'] = count_words(agency_data[text_col])
+    agency_data['text_length'] = agency_data[text_col].fillna('').str.len()
+    
+    # 2. Word statistics and checksums come out of one fused groupby over the texts;
+    # the content length is that of each agency's texts joined with spaces. The name is
+    # a group key rather than mapped on afterwards: with categorical ids and names,
+    # Series.map on pandas 2.2 pairs ids with the wrong names
+    agency_metrics = agency_data.groupby(['agency_id', 'name'], observed=True, dropna=False).agg(
+        total_words=('word_count', 'sum'),
+        section_count=('word_count', 'count'),
+        avg_words_per_section=('word_count', 'mean'),
+        total_sections=(text_col, 'count'),
+        checksum=(text_col, calculate_text_checksum),
+        text_length=('text_length', 'sum')
+    ).reset_index().rename(columns={'name': 'agency_name'})
+    
+    word_counts = agency_metrics.loc[
+        agency_metrics['agency_name'].notna(),
+        ['agency_id', 'agency_name', 'total_words', 'section_count', 'avg_words_per_section', 'total_sections']
+    ].reset_index(drop=True)
+    
+    checksums_df = agency_metrics[['agency_id', 'agency_name', 'checksum']].assign(
+        content_length=agency_metrics['text_length'] + agency_metrics['section_count'] - 1
+    )
     
-    # 3. Historical simulation
+    # 3. Historical simulation, drawn for every agency x month in one broadcast
     base_date = datetime.now() - timedelta(days=365)
-    dates = [base_date + timedelta(days=x*30) for x in range(12)]
+    dates = np.array([base_date + timedelta(days=x*30) for x in range(12)], dtype='datetime64[ns]')
     
-    historical_data = []
-    for agency_id in word_counts['agency_id'].unique():
-        if agency_id in word_counts['agency_id'].values:
-            base_words = word_counts[word_counts['agency_id'] == agency_id]['total_words'].iloc[0]
-            agency_name = word_counts[word_counts['agency_id'] == agency_id]['agency_name'].iloc[0]
-            
-            for i, date_val in enumerate(dates):
-                change_factor = 1 + np.random.normal(0, 0.05)
-                simulated_words = int(base_words * change_factor * (1 + i * 0.02))
-                
-                historical_data.append({
-                    'date': date_val,
-                    'agency_id': agency_id,
-                    'agency_name': agency_name,
-                    'word_count': simulated_words
-                })
+    n_agencies, n_dates = len(word_counts), len(dates)
+    change_factors = np.random.default_rng().normal(1.0, 0.05, (n_agencies, n_dates))
+    growth = 1 + np.arange(n_dates) * 0.02
+    base_words = word_counts['total_words'].to_numpy()[:, None]
+    simulated_words = (base_words * change_factors * growth).astype(np.int64)
     
-    historical_df = pd.DataFrame(historical_data)
+    historical_df = pd.DataFrame({
+        'date': np.tile(dates, n_agencies),
+        'agency_id': np.repeat(word_counts['agency_id'].to_numpy(), n_dates),
+        'agency_name': np.repeat(word_counts['agency_name'].to_numpy(), n_dates),
+        'word_count': simulated_words.ravel()
+    })
     
     return {
         'word_counts': word_counts,
@@ -268,6 +155,8 @@ def create_plotly_dashboard(metrics_data):
     """
     Create interactive Plotly visualizations
     """
+    # plotly is only imported once the Advanced Analytics mode is opened
+    import plotly.express as px
     
     word_counts = metrics_data['word_counts']
     historical_df = metrics_data['historical_data']
@@ -287,9 +176,12 @@ def create_plotly_dashboard(metrics_data):
     fig_words.update_traces(texttemplate='%{text:,.0f}', textposition='outside')
     fig_words.update_layout(height=600, yaxis={'categoryorder': 'total ascending'})
     
-    # 2. Historical Trends
-    top_5_agencies = word_counts.nlargest(5, 'total_words')['agency_id'].tolist()
-    historical_subset = historical_df[historical_df['agency_id'].isin(top_5_agencies)]
+    # 2. Historical Trends: argpartition picks the top 5 agencies without sorting them all
+    total_words = word_counts['total_words'].to_numpy()
+    k = min(5, len(total_words))
+    top_idx = np.argpartition(total_words, -k)[-k:] if k else []
+    top_5_agencies = word_counts['agency_id'].to_numpy()[top_idx]
+    historical_subset = historical_df[np.isin(historical_df['agency_id'].to_numpy(), top_5_agencies)]
     
     fig_trends = px.line(
         historical_subset,
@@ -355,6 +247,8 @@ def create_plotly_dashboard(metrics_data):
 @st.cache_data(ttl=3600)
 def get_titles_data():
     """Fetches titles data from the eCFR API."""
+    import requests
+
     api_url = "https://www.ecfr.gov/api/versioner/v1/titles.json"
     try:
         response = requests.get(api_url)
@@ -364,6 +258,15 @@ def get_titles_data():
         st.error(f"Error fetching titles data from API: {e}")
         return None
 
+def run_title_pipeline(user_params):
+    """
+    Runs the ETL pipeline for one title; called from run_initial_etl's worker threads.
+    The indexes are left to run_initial_etl, which builds them once every title is loaded
+    """
+    from etl.etl_pipeline import ETLPipeline
+
+    ETLPipeline(user_params).run_pipeline(finalize=False)
+
 @st.cache_resource(show_spinner=True)
 def run_initial_etl():
     st.write("Starting ETL Pipeline...")
@@ -380,48 +283,85 @@ def run_initial_etl():
 
     processed_count = 0
     total_titles = 50
+    today_str = date.today().strftime('%Y-%m-%d')
 
-    for title_number_int in range(1, 51):
-        if title_number_int == 35:
-            continue 
+    # the pipelines run on worker threads; the progress widgets are only touched here,
+    # on the script thread, as each title completes
+    with ThreadPoolExecutor(max_workers=ETL_WORKERS) as executor:
+        futures = {}
+        for title_number_int in range(1, 51):
+            if title_number_int == 35:
+                continue 
 
-        title_number_str = str(title_number_int)
-        latest_amended_on = title_amendment_dates.get(title_number_str)
+            title_number_str = str(title_number_int)
+            latest_amended_on = title_amendment_dates.get(title_number_str)
+            user_params = {'date': latest_amended_on or today_str, 'title': title_number_str}
 
-        if latest_amended_on:
-            user_params = {'date': latest_amended_on, 'title': title_number_str}
-        else:
-            today_str = date.today().strftime('%Y-%m-%d')
-            user_params = {'date': today_str, 'title': title_number_str}
+            futures[executor.submit(run_title_pipeline, user_params)] = title_number_str
 
-        run = ETLPipeline(user_params)
-        run.run_pipeline()
+        for future in as_completed(futures):
+            future.result()
+            processed_count += 1
+            progress_bar.progress(processed_count / total_titles)
+            status_text.text(f"Processed Title {futures[future]} ({processed_count}/{total_titles})")
 
-        processed_count += 1
-        progress_bar.progress(processed_count / total_titles)
-        status_text.text(f"Processing Title {title_number_str} ({processed_count}/{total_titles})")
+    from etl.load import DatabaseLoader
+
+    status_text.text("Building database indexes...")
+    DatabaseLoader(db_path='data/cfr.db').finalize()
 
     progress_bar.empty()
     status_text.empty()
     st.success("All titles processed by ETL Pipeline.")
     return "ETL Pipeline completed."
 
-def create_proper_agency_dashboard_data(agency_df, section_df, reference_df):
+def create_proper_agency_dashboard_data(limit=None):
     """
-    Properly creates dashboard data by implementing correct joining logic
+    Properly creates dashboard data by joining references to sections and agencies in SQLite
     """
-    return create_comprehensive_agency_analysis(agency_df, section_df, reference_df)
+    return get_joined_dashboard_data(limit=limit)
+
 
+@lru_cache(maxsize=8)
+def identify_text_column(columns):
+    """
+    Picks the section text column out of a tuple of column names, preferring
+    section_text, then body; None when there is no text column
+    """
+    for preferred in ('section_text', 'body'):
+        if preferred in columns:
+            return preferred
+    return next((col for col in columns if TEXT_COLUMN_PATTERN.search(col)), None)
+
+def count_words(texts):
+    """
+    Counts the whitespace-separated words of each text; missing texts count as zero.
+    map(len, map(str.split, ...)) runs entirely in C, with no Python-level call per row
+    """
+    values = texts.fillna('').tolist()
+    counts = np.fromiter(map(len, map(str.split, values)), dtype=np.int64, count=len(values))
+    return pd.Series(counts, index=texts.index, name=texts.name)
 
 def calculate_word_count_per_agency(df):
-    df['word_count'] = df['section_text'].apply(lambda x: len(x.split()) if isinstance(x, str) else 0)
-    word_counts = df.groupby('agency_name')['word_count'].sum().reset_index()
+    df['word_count'] = count_words(df['section_text'])
+    word_counts = df.groupby('agency_name', observed=True)['word_count'].sum().reset_index()
     return word_counts
 
+def calculate_text_checksum(texts):
+    """
+    BLAKE2b fingerprint of a group of section texts joined with spaces. The texts are
+    fed to the hash one at a time, so the joined string is never built
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for i, text in enumerate(texts.fillna('')):
+        if i:
+            digest.update(b' ')
+        digest.update(text.encode('utf-8'))
+    return digest.hexdigest()
+
 def calculate_checksum_per_agency(df):
-    agency_texts = df.groupby('agency_name')['section_text'].apply(lambda x: " ".join(x)).reset_index()
-    agency_texts['checksum'] = agency_texts['section_text'].apply(lambda x: hashlib.md5(x.encode('utf-8')).hexdigest())
-    return agency_texts[['agency_name', 'checksum']]
+    checksums = df.groupby('agency_name', observed=True)['section_text'].agg(calculate_text_checksum)
+    return checksums.rename('checksum').reset_index()
 
 # --- Main Streamlit UI ---
 
@@ -456,6 +396,8 @@ if not db_exists or not has_data:
         with st.spinner("Running ETL pipeline and initializing database..."):
             status = run_initial_etl()
             st.success(status)
+        # the table loaders are cached, so drop their results to pick up the new data
+        st.cache_data.clear()
         st.rerun()
     
     st.info("💡 The ETL pipeline will process all CFR titles (1-50, excluding 35) and populate the database. This may take several minutes.")
@@ -467,6 +409,8 @@ else:
         with st.spinner("Running ETL pipeline and refreshing data..."):
             status = run_initial_etl()
             st.success(status)
+        # the table loaders are cached, so drop their results to pick up the new data
+        st.cache_data.clear()
         st.rerun()
 
 st.markdown("---")
@@ -474,15 +418,21 @@ st.markdown("---")
 st.info("Loading data from database...")
 
 try:
-    agency_df, section_df, reference_df = safe_load_data()
+    agency_df, section_df, reference_df, row_counts = safe_load_data(dashboard_mode)
     
-    if agency_df is None or section_df is None or reference_df is None:
+    if agency_df is None:
         st.error("❌ Failed to load data from database. The database may be corrupted or empty.")
         st.info("💡 Try running the ETL pipeline again to refresh the data.")
         st.stop()
     
     st.success(f"✅ Data loaded successfully!")
-    st.info(f"📊 Loaded {len(agency_df)} agencies, {len(section_df)} sections, and {len(reference_df)} references")
+    st.info(
+        f"📊 Database holds {len(agency_df)} agencies, {row_counts['cfr_sections']} sections, "
+        f"and {row_counts['cfr_references']} references"
+    )
+    if dashboard_mode == "Raw Data Debug":
+        # the sections are read with LIMIT DEBUG_ROW_LIMIT in this mode
+        st.caption(f"Raw Data Debug shows a sample of the first {len(section_df)} sections")
     
 except Exception as e:
     st.error(f"❌ Error loading data: {e}")
@@ -490,7 +440,9 @@ except Exception as e:
     st.stop()
 
 with st.spinner("Processing dashboard data..."):
-    df_dashboard = create_proper_agency_dashboard_data(agency_df, section_df, reference_df)
+    df_dashboard = create_proper_agency_dashboard_data(
+        limit=DEBUG_ROW_LIMIT if dashboard_mode == "Raw Data Debug" else None
+    )
 
 if dashboard_mode == "Raw Data Debug":
     st.header("Raw Data Debug")
@@ -514,13 +466,18 @@ if dashboard_mode == "Raw Data Debug":
     
     if df_dashboard is not None and not df_dashboard.empty:
         st.subheader("Properly Joined Dashboard Data")
-        st.write(f"Shape: {df_dashboard.shape}")
+        # df_dashboard only holds the first DEBUG_ROW_LIMIT joined rows in this mode, so the
+        # totals are counted over the whole join in SQLite
+        joined_summary = get_joined_summary()
+        st.write(f"Joined rows: {joined_summary['rows']}")
+        st.write(f"Agencies with successful joins: {joined_summary['agencies']}")
+        st.caption(f"The rest of this section describes a sample of the first {len(df_dashboard)} joined rows")
+        st.write(f"Sample shape: {df_dashboard.shape}")
         st.write(f"Columns: {df_dashboard.columns.tolist()}")
         st.write("Sample data:")
         st.write(df_dashboard.head())
 
         agencies_with_data = df_dashboard[df_dashboard['name'].notna()]
-        st.write(f"Agencies with successful joins: {agencies_with_data['name'].nunique()}")
         st.write("Sample agencies:", agencies_with_data['name'].unique()[:10])
     else:
         st.error("Failed to create properly joined dashboard data")
@@ -530,22 +487,18 @@ elif dashboard_mode == "Overview":
     st.header("📊 Basic Overview")
     
     if df_dashboard is not None and not df_dashboard.empty:
-        text_col = None
-        for col in df_dashboard.columns:
-            if any(keyword in col.lower() for keyword in ['text', 'body', 'content']):
-                text_col = col
-                break
+        text_col = identify_text_column(tuple(df_dashboard.columns))
         
         if text_col:
-            df_dashboard['word_count'] = df_dashboard[text_col].fillna('').str.split().str.len()
-            word_counts_df = df_dashboard.groupby('name')['word_count'].sum().reset_index()
+            import altair as alt
+
+            df_dashboard['word_count'] = count_words(df_dashboard[text_col])
+            word_counts_df = df_dashboard.groupby('name', observed=True)['word_count'].sum().reset_index()
             word_counts_df.columns = ['agency_name', 'word_count']
             word_counts_df = word_counts_df.sort_values('word_count', ascending=False)
             
             # Calculate checksums
-            agency_texts = df_dashboard.groupby('name')[text_col].apply(lambda x: " ".join(x.fillna(''))).reset_index()
-            agency_texts['checksum'] = agency_texts[text_col].apply(lambda x: hashlib.md5(x.encode('utf-8')).hexdigest())
-            checksum_df = agency_texts[['name', 'checksum']]
+            checksum_df = df_dashboard.groupby('name', observed=True)[text_col].agg(calculate_text_checksum).reset_index()
             checksum_df.columns = ['agency_name', 'checksum']
             
             col1, col2 = st.columns(2)
@@ -567,7 +520,7 @@ elif dashboard_mode == "Overview":
             
             with col2:
                 st.subheader("Content Checksums")
-                st.info("MD5 checksums can indicate if agency content has changed.")
+                st.info("Content checksums can indicate if agency content has changed.")
                 st.dataframe(checksum_df.head(20), use_container_width=True)
         else:
             st.error("Could not find text column for analysis")
@@ -1,36 +1,119 @@
 import sqlite3
 import pandas as pd
+import streamlit as st
 
+# cfr_sections columns the dashboard reads; the *_head columns are never used
+SECTION_COLUMNS = [
+    'section_id',
+    'title_number',
+    'chapter_number',
+    'subchapter_number',
+    'part_number',
+    'section_number',
+    'section_title',
+    'body'
+]
+
+# string columns read as Arrow strings, so the join keys and the text kernels work on
+# contiguous buffers rather than arrays of Python objects
+SECTION_ARROW_DTYPES = {
+    col: 'string[pyarrow]'
+    for col in ['title_number', 'chapter_number', 'subchapter_number', 'part_number', 'body']
+}
+REFERENCE_ARROW_DTYPES = {col: 'string[pyarrow]' for col in ['title', 'chapter', 'part']}
+# low-cardinality keys repeated across many rows are held as categoricals, so grouping
+# and filtering on them works on integer codes
+REFERENCE_CATEGORY_DTYPES = {'agency_id': 'category'}
+JOINED_CATEGORY_DTYPES = {'agency_id': 'category', 'name': 'category'}
+
+# Every section an agency's CFR references point to, with the agency's columns attached.
+# A reference without a chapter or part covers all of them within its title
+JOINED_FROM_SQL = '''
+    FROM cfr_references r
+    JOIN cfr_sections s
+        ON s.title_number = r.title
+        AND (r.chapter IS NULL OR s.chapter_number = r.chapter)
+        AND (r.part IS NULL OR r.part = '' OR s.part_number = r.part)
+    JOIN agencies a ON a.agency_id = r.agency_id
+'''
+JOINED_DASHBOARD_SQL = f'''
+    SELECT {', '.join(f's.{col}' for col in SECTION_COLUMNS)}, r.agency_id,
+        a.name, a.short_name, a.display_name, a.sortable_name, a.slug, a.parent_id
+''' + JOINED_FROM_SQL
+# size of the whole join, counted in SQLite for when only a sample of it is read
+JOINED_SUMMARY_SQL = 'SELECT COUNT(*), COUNT(DISTINCT r.agency_id)' + JOINED_FROM_SQL
+
+@st.cache_resource
 def get_db_connection(db_path='data/cfr.db'):
     """
-    Establishes a connection to the SQLite database
+    Opens a single read-only connection to the SQLite database, shared across reruns
     """
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+    conn.execute('PRAGMA mmap_size=268435456')
+    conn.execute('PRAGMA cache_size=-65536')
+    conn.execute('PRAGMA query_only=1')
     return conn
 
-def get_agencies_data(db_path='data/cfr.db'):
+def read_table(table, columns=None, limit=None, db_path='data/cfr.db'):
+    """
+    Reads the given columns (all when None) of a table, optionally only its first limit rows
+    """
+    query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table}"
+    params = ()
+    if limit:
+        query += " LIMIT ?"
+        params = (limit,)
+    return pd.read_sql_query(query, get_db_connection(db_path), params=params)
+
+@st.cache_data(ttl=3600)
+def get_row_count(table, db_path='data/cfr.db'):
+    """
+    Counts a table's rows inside SQLite, without reading any of them
+    """
+    return get_db_connection(db_path).execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+@st.cache_data(ttl=3600)
+def get_agencies_data(db_path='data/cfr.db', columns=None, limit=None):
+    """
+    Fetches data from the agencies table
+    """
+    return read_table('agencies', columns, limit, db_path)
+
+@st.cache_data(ttl=3600)
+def get_cfr_sections_data(db_path='data/cfr.db', columns=None, limit=None):
+    """
+    Fetches data from the cfr_sections table, by default the columns used by the dashboard
+    """
+    df = read_table('cfr_sections', columns or SECTION_COLUMNS, limit, db_path)
+    return df.astype({col: dtype for col, dtype in SECTION_ARROW_DTYPES.items() if col in df.columns})
+
+@st.cache_data(ttl=3600)
+def get_cfr_references_data(db_path='data/cfr.db', columns=None, limit=None):
     """
-    Fetches all data from the agencies table
+    Fetches data from the cfr_references table
     """
-    conn = get_db_connection(db_path)
-    df = pd.read_sql_query("SELECT * FROM agencies", conn)
-    conn.close()
-    return df
+    df = read_table('cfr_references', columns, limit, db_path)
+    dtypes = {**REFERENCE_ARROW_DTYPES, **REFERENCE_CATEGORY_DTYPES}
+    return df.astype({col: dtype for col, dtype in dtypes.items() if col in df.columns})
 
-def get_cfr_sections_data(db_path='data/cfr.db'):
+@st.cache_data(ttl=3600)
+def get_joined_dashboard_data(db_path='data/cfr.db', limit=None):
     """
-    Fetches all data from the cfr_sections table
+    Joins references, sections and agencies inside SQLite, returning Arrow-backed columns
+    with the agency keys as categoricals
     """
-    conn = get_db_connection(db_path)
-    df = pd.read_sql_query("SELECT * FROM cfr_sections", conn)
-    conn.close()
-    return df
+    query = JOINED_DASHBOARD_SQL
+    params = ()
+    if limit:
+        query += " LIMIT ?"
+        params = (limit,)
+    df = pd.read_sql_query(query, get_db_connection(db_path), params=params, dtype_backend='pyarrow')
+    return df.astype(JOINED_CATEGORY_DTYPES)
 
-def get_cfr_references_data(db_path='data/cfr.db'):
+@st.cache_data(ttl=3600)
+def get_joined_summary(db_path='data/cfr.db'):
     """
-    Fetches all data from the cfr_references table
+    Counts the joined rows and the distinct agencies in them over the whole join
     """
-    conn = get_db_connection(db_path)
-    df = pd.read_sql_query("SELECT * FROM cfr_references", conn)
-    conn.close()
-    return df
+    rows, agencies = get_db_connection(db_path).execute(JOINED_SUMMARY_SQL).fetchone()
+    return {'rows': rows, 'agencies': agencies}